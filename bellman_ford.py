@@ -10,6 +10,133 @@ Use a graph to detect an arbitrage.
 This module will return the negative cycle path to get reported on.
 """
 
+from array import array
+from collections import deque
+from collections.abc import Mapping
+import logging
+
+INF = float("inf")
+
+logger = logging.getLogger(__name__)
+
+def relax(u_idx, v_idx, w, passes, start, tolerance, dist, pred):
+    """
+    Bellman-Ford kernel working only on vertex indices and flat edge arrays, so it carries no
+    dependency on the graph object. dist and pred are filled in place.
+
+    :param u_idx: source vertex index of each edge
+    :param v_idx: destination vertex index of each edge
+    :param w: weight of each edge
+    :param passes: number of passes over the edges to run
+    :param start: index of the start vertex
+    :param tolerance: only if a path is more than tolerance better will it be relaxed
+    :param dist: distances, initialized to infinity except dist[start] = 0
+    :param pred: predecessors, initialized to -1
+    :return: None if no negative cycle, otherwise the last edge (u, v) of vertex indices relaxed, whose
+        predecessor chain runs into one such cycle
+    """
+    edges = list(zip(u_idx, v_idx, w))
+    changed = None
+
+    #Run Bellman Ford algorithm to find all shortest paths
+    for i in range(passes):
+        changed = None
+        for u, v, wt in edges:
+            cand = dist[u] + wt
+            #Make sure both ways to/from start vertex resolve to 0, if not, there's a negative cycle
+            if dist[v] - cand > tolerance:
+                if v == start:
+                    return (u, v)
+
+                #Update distance otherwise
+                dist[v] = cand
+                pred[v] = u
+                changed = (u, v)
+
+        #Nothing relaxed in this pass, so all shortest paths have been identified
+        if changed is None:
+            return None
+
+    #Still relaxing on the |V|th pass means there's a negative cycle behind the last relaxed edge
+    return changed
+
+def spfa(out, v_idx, w, start, tolerance, dist, pred, queue, in_queue):
+    """
+    SPFA kernel working only on vertex indices and flat edge arrays, like relax. Relaxes the outgoing
+    edges of queued vertices until nothing changes any more, queueing every vertex whose distance
+    went down. dist, pred, queue and in_queue are updated in place.
+
+    :param out: slots of the outgoing edges of each vertex
+    :param v_idx: destination vertex index of each edge
+    :param w: weight of each edge
+    :param start: index of the start vertex
+    :param tolerance: only if a path is more than tolerance better will it be relaxed
+    :param dist: current distances
+    :param pred: current predecessors, -1 when there's none
+    :param queue: deque of vertices whose outgoing edges need relaxing
+    :param in_queue: True for each vertex currently in queue
+    :return: None if no negative cycle, otherwise an edge (u, v) of vertex indices whose
+        predecessor chain runs into one such cycle
+    """
+    n = len(dist)
+    dequeued = [0] * n
+
+    while queue:
+        u = queue.popleft()
+        in_queue[u] = False
+
+        #a vertex coming back more than |V| times can only be going around a negative cycle
+        dequeued[u] += 1
+        if dequeued[u] > n:
+            return (pred[u], u)
+
+        du = dist[u]
+        for i in out[u]:
+            v = v_idx[i]
+            cand = du + w[i]
+            if dist[v] - cand > tolerance:
+                if v == start:
+                    return (u, v)
+
+                dist[v] = cand
+                pred[v] = u
+                if not in_queue[v]:
+                    queue.append(v)
+                    in_queue[v] = True
+
+    return None
+
+class VertexMap(Mapping):
+    """
+    Read-only view of a per-vertex list keyed by vertex name. Values are only translated back to names
+    for the entries a client actually looks at, and the view follows later updates to the graph.
+    """
+
+    def __init__(self, values, graph, translate=False):
+        """
+        Constructor for VertexMap object
+
+        :param: values: list indexed by vertex index
+        :param: graph: the BellmanFord graph the indices belong to
+        :param: translate: True if the values are vertex indices to be returned as names (-1 as None)
+        """
+        self.values = values
+        self.graph = graph
+        self.translate = translate
+
+    def __getitem__(self, vertex):
+        value = self.values[self.graph.vertex_id[vertex]]
+        if self.translate:
+            return self.graph.vertex_name[value] if value >= 0 else None
+        return value
+
+    def __iter__(self):
+        return iter(self.graph.vertex_name)
+
+    def __len__(self):
+        return len(self.graph.vertex_name)
+
+
 class BellmanFord:
 
     def __init__(self, g=None):
@@ -19,7 +146,30 @@ class BellmanFord:
         :param: g: the graph inititially provided by the client
         """
         self.vertices = set()    #the number of vertices stored as a set   
-        self.edges = {}   #edge storage
+        self.vertex_id = {}      #vertex -> small int index
+        self.vertex_name = []    #small int index -> vertex
+
+        #edge storage, kept as parallel arrays (one slot per edge)
+        self.u_idx = array('i')
+        self.v_idx = array('i')
+        self.w = array('d')
+        #dense adjacency matrix of edge slots, row u holds the slots of u's edges (-1 for no edge),
+        #so finding an edge is plain index arithmetic instead of hashing
+        self.stride = 0
+        self.slot = array('i')
+        self.out = []       #vertex index -> slots of its outgoing edges
+        self.in_degree = [] #vertex index -> number of incoming edges
+
+        #shortest path state kept between calls, so edge updates only re-relax what they affect
+        self.source = None      #index of the vertex the state was computed from
+        self.tolerance = 0
+        self.valid = False      #False when the state has to be recomputed from scratch
+        self.dist = []
+        self.pred = []
+        self.unreached = []     #all infinity and all -1, copied over dist and pred to reset them
+        self.no_pred = []
+        self.queue = deque()    #vertices whose outgoing edges need relaxing
+        self.in_queue = []
         if g is not None: 
             self.buildEdge(g)
     
@@ -50,14 +200,36 @@ class BellmanFord:
         :param: ver2: vertex 2
         """
 
-        
-        self.vertices.add(ver1)
-        self.vertices.add(ver2)
+        for ver in (ver1, ver2):
+            if ver not in self.vertex_id:
+                self.vertex_id[ver] = len(self.vertex_name)
+                self.vertex_name.append(ver)
+                self.vertices.add(ver)
+                self.out.append([])
+                self.in_degree.append(0)
+                self.dist.append(INF)
+                self.pred.append(-1)
+                self.unreached.append(INF)
+                self.no_pred.append(-1)
+                self.in_queue.append(False)
+
+                if len(self.vertex_name) > self.stride:
+                    self.grow_slots()
 
+    def grow_slots(self):
+        """
+        Helper function to double the width of the adjacency matrix once we run out of rows, copying
+        the existing rows over
+        """
+        old, stride = self.slot, self.stride
+        self.stride = max(8, 2 * stride)
+        self.slot = array('i', [-1]) * (self.stride * self.stride)
+        for u in range(stride):
+            self.slot[u * self.stride:u * self.stride + stride] = old[u * stride:(u + 1) * stride]
 
     def add_edge(self,edge):
         """
-        Function to add edges to our edge storage
+        Function to add edges to our edge storage. An existing edge has its weight updated in place.
 
         :param: edge: a tuple in format (currency1, currency2, weight)
         """
@@ -65,11 +237,29 @@ class BellmanFord:
         #update the vertices set
         self.add_vertices(curr1, curr2)
 
-        #add to the edge storage
-        if curr1 not in self.edges:
-            self.edges[curr1] = {}
-        
-        self.edges[curr1][curr2] = weight
+        u = self.vertex_id[curr1]
+        v = self.vertex_id[curr2]
+        i = self.slot[u * self.stride + v]
+        if i >= 0:
+            heavier = weight > self.w[i]
+            self.w[i] = weight
+            #a heavier edge on a shortest path leaves dist too low for everything reached through it
+            if heavier and self.pred[v] == u:
+                self.invalidate(v)
+        else:
+            #add to the end of the edge storage
+            i = len(self.w)
+            self.u_idx.append(u)
+            self.v_idx.append(v)
+            self.w.append(weight)
+            self.slot[u * self.stride + v] = i
+            self.out[u].append(i)
+            self.in_degree[v] += 1
+
+        #only the edge's source has to be re-relaxed if the edge now gives a shorter path
+        if self.valid and self.dist[v] - (self.dist[u] + weight) > self.tolerance and not self.in_queue[u]:
+            self.queue.append(u)
+            self.in_queue[u] = True
 
     def remove_edge(self, curr1, curr2):
         """
@@ -77,11 +267,93 @@ class BellmanFord:
         """
 
         #only try to remove when keys are valid
-        if curr1 in self.edges and curr2 in self.edges[curr1]:
-            del self.edges[curr1][curr2]
+        u = self.vertex_id.get(curr1)
+        v = self.vertex_id.get(curr2)
+        i = self.slot[u * self.stride + v] if u is not None and v is not None else -1
+        if i >= 0:
+            self.slot[u * self.stride + v] = -1
+            self.out[u].remove(i)
+            self.in_degree[v] -= 1
+
+            #keep the edge storage dense by moving the last edge into the freed slot
+            last = len(self.w) - 1
+            if i != last:
+                lu, lv = self.u_idx[last], self.v_idx[last]
+                self.u_idx[i], self.v_idx[i], self.w[i] = lu, lv, self.w[last]
+                self.slot[lu * self.stride + lv] = i
+                self.out[lu][self.out[lu].index(last)] = i
+            self.u_idx.pop()
+            self.v_idx.pop()
+            self.w.pop()
+
+            #a removed edge on a shortest path leaves dist too low for everything reached through it
+            if self.pred[v] == u:
+                self.invalidate(v)
         else:
-            print('Not a valid key. No data was removed.')
+            logger.debug('Not a valid key. No data was removed.')
+
+    def invalidate(self, vertex):
+        """
+        Helper function to forget the distances of vertex and everything whose shortest path runs through
+        it, i.e. its subtree in the predecessor tree. Vertices outside the subtree keep their distances,
+        and the ones with an edge into the subtree are queued so the next drain rebuilds it from there.
+
+        :param: vertex: index of the vertex whose shortest path edge got heavier or was removed
+        """
+        if not self.valid:
+            return
+
+        children = [[] for _ in self.vertex_name]
+        for v, p in enumerate(self.pred):
+            if p >= 0:
+                children[p].append(v)
+
+        in_subtree = bytearray(len(self.vertex_name))
+        in_subtree[vertex] = 1
+        stack = [vertex]
+        while stack:
+            u = stack.pop()
+            self.dist[u] = INF
+            self.pred[u] = -1
+            for child in children[u]:
+                if not in_subtree[child]:
+                    in_subtree[child] = 1
+                    stack.append(child)
+
+        for u, v in zip(self.u_idx, self.v_idx):
+            if in_subtree[v] and not in_subtree[u] and self.dist[u] < INF and not self.in_queue[u]:
+                self.queue.append(u)
+                self.in_queue[u] = True
+
+    @property
+    def edges(self):
+        """
+        Dictionary view of the stored edges in format {currency1: {currency2: weight}}, used for reporting
+        """
+        view = {}
+        for u, v, w in zip(self.u_idx, self.v_idx, self.w):
+            view.setdefault(self.vertex_name[u], {})[self.vertex_name[v]] = w
+        return view
+
+
+    def edge_count(self):
+        """
+        Number of edges currently stored
 
+        >>> BellmanFord({'a': {'b': 1, 'c': 2}, 'b': {'a': -1}}).edge_count()
+        3
+        """
+        return len(self.w)
+
+    def on_cycle_possible(self, vertex):
+        """
+        Cheap check for whether vertex could be on a cycle at all, i.e. it has edges both in and out.
+
+        :param: vertex: the vertex to check
+        :return: False if vertex can't be on any cycle, True if it might be
+        """
+        v = self.vertex_id.get(vertex)
+        return v is not None and self.in_degree[v] > 0 and len(self.out[v]) > 0
 
     def shortest_paths(self, start_vertex, tolerance):
         """
@@ -95,58 +367,166 @@ class BellmanFord:
         to be close to zero.
 
         >>> g = BellmanFord({'a': {'b': 1, 'c':5}, 'b': {'c': 2, 'a': 10}, 'c': {'a': 14, 'd': -3}, 'e': {'a': 100}})
-        >>> dist, prev, neg_edge = g.shortest_paths('a')
+        >>> dist, prev, neg_edge = g.shortest_paths('a', 0)
         >>> [(v, dist[v]) for v in sorted(dist)]  # shortest distance from 'a' to each other vertex
-        [('a', 0), ('b', 1), ('c', 3), ('d', 0), ('e', inf)]
+        [('a', 0.0), ('b', 1.0), ('c', 3.0), ('d', 0.0), ('e', inf)]
         >>> [(v, prev[v]) for v in sorted(prev)]  # last edge in shortest paths
         [('a', None), ('b', 'a'), ('c', 'b'), ('d', 'c'), ('e', None)]
         >>> neg_edge is None
         True
-        >>> g.add_edge('a', 'e', -200)
-        >>> dist, prev, neg_edge = g.shortest_paths('a')
+        >>> g.add_edge(('a', 'e', -200))
+        >>> dist, prev, neg_edge = g.shortest_paths('a', 0)
         >>> neg_edge  # edge where we noticed a negative cycle
         ('e', 'a')
 
+        Weights are compared as raw floats, so tolerance is what absorbs the rounding error of a
+        cycle of consistent rates that should sum to exactly zero:
+
+        >>> from math import log
+        >>> g = BellmanFord({'USD': {'EUR': -log(1.25)}, 'EUR': {'GBP': -log(1.1)}, 'GBP': {'USD': -log(1 / (1.25 * 1.1))}})
+        >>> g.shortest_paths('USD', 0)[2]  # off by one ulp
+        ('GBP', 'USD')
+        >>> g.shortest_paths('USD', 1e-12)[2] is None
+        True
+
+        A negative self-loop is a negative cycle too:
+
+        >>> BellmanFord({'a': {'b': 1, 'c': 1}, 'b': {'b': -1}}).shortest_paths('a', 0)[2]
+        ('b', 'b')
+
         :param start_vertex: start of all paths
         :param tolerance: only if a path is more than tolerance better will it be relaxed
         :return: distance, predecessor, negative_cycle
-            distance:       dictionary keyed by vertex of shortest distance from start_vertex to that vertex
-            predecessor:    dictionary keyed by vertex of previous vertex in shortest path from start_vertex
+            distance:       mapping keyed by vertex of shortest distance from start_vertex to that vertex
+            predecessor:    mapping keyed by vertex of previous vertex in shortest path from start_vertex
             negative_cycle: None if no negative cycle, otherwise an edge, (u,v), in one such cycle
         """
         #Initialize all distances to be infinity, except start_vertex = 0
-        dist = {}
-        pred = {}
-        neg_cycle = tuple()
-
-        for v in self.vertices:
-            dist[v] = float("inf")
-            pred[v] = None
-
-        dist[start_vertex] = 0
-
-        #Run Bellman Ford algorithm to find all shortest paths
-        for i in range(len(self.vertices)):
-            for u in self.edges:
-                for v in self.edges[u]:
-                    w = self.edges[u][v]
-
-                    #Make sure both ways to/from start vertex resolve to 0, if not, there's a negative cycle
-                    if round(dist[v], 12) - round((dist[u] + w), 12) > tolerance:
-                        if v == start_vertex:
-                            return dist, pred, (u, v)
-                    
-                    #Update distance otherwise
-                        dist[v] = dist[u] + w
-                        pred[v] = u
-
-        #Last check after all shortest paths have been identified
-        for u in self.edges:
-            for v in self.edges[u]:
-                w = self.edges[u][v]
-                if round((dist[u] + w), 12) < round(dist[v], 12):
-                    neg_cycle = (u, v)
-                    print('2. found negative cycle: ', neg_cycle)
-                    return dist, pred, neg_cycle    #return the first negative cycle found
-
-        return dist, pred, neg_cycle 
\ No newline at end of file
+        n = len(self.vertex_name)
+        dist = self.dist
+        pred = self.pred
+        dist[:] = self.unreached
+        pred[:] = self.no_pred
+        start = self.vertex_id[start_vertex]
+        dist[start] = 0.0
+
+        neg_cycle = relax(self.u_idx, self.v_idx, self.w, n, start, tolerance, dist, pred)
+
+        #keep the result as the starting point for incremental_paths
+        self.source = start
+        self.tolerance = tolerance
+        self.valid = neg_cycle is None
+        self.clear_queue()
+        return self.by_name(dist, pred, neg_cycle)
+
+    def incremental_paths(self, start_vertex, tolerance):
+        """
+        Same as shortest_paths, but starting from the distances of the previous call and only
+        re-relaxing the vertices queued up by add_edge since then. Falls back to spfa_shortest_paths
+        when there's no usable previous state, e.g. after an edge on a shortest path got heavier or
+        was removed.
+
+        >>> g = BellmanFord({'a': {'b': 1, 'c':5}, 'b': {'c': 2, 'a': 10}, 'c': {'a': 14, 'd': -3}, 'e': {'a': 100}})
+        >>> dist, prev, neg_edge = g.incremental_paths('a', 0)
+        >>> g.add_edge(('a', 'd', -1))
+        >>> dist, prev, neg_edge = g.incremental_paths('a', 0)
+        >>> dist['d'], prev['d'], neg_edge
+        (-1.0, 'a', None)
+        >>> g.add_edge(('d', 'a', -1))
+        >>> g.incremental_paths('a', 0)[2]
+        ('d', 'a')
+
+        :param start_vertex: start of all paths
+        :param tolerance: only if a path is more than tolerance better will it be relaxed
+        :return: distance, predecessor, negative_cycle as for shortest_paths
+        """
+        start = self.vertex_id[start_vertex]
+        if not self.valid or self.source != start or self.tolerance != tolerance:
+            return self.spfa_shortest_paths(start_vertex, tolerance)
+
+        return self.by_name(self.dist, self.pred, self.drain(start, tolerance))
+
+    def is_settled(self, start_vertex, tolerance):
+        """
+        Check if incremental_paths would have nothing to do: the distances from start_vertex are up to date
+        and no edge update since the last call made any path shorter.
+
+        :param start_vertex: start of all paths
+        :param tolerance: tolerance the distances have to be computed with
+        :return: True if the last result still holds
+        """
+        return self.valid and not self.queue and self.source == self.vertex_id.get(start_vertex) \
+            and self.tolerance == tolerance
+
+    def spfa_shortest_paths(self, start_vertex, tolerance):
+        """
+        Same as shortest_paths, but using SPFA (Shortest Path Faster Algorithm): only vertices whose
+        distance just went down get their outgoing edges relaxed, instead of every edge on every pass.
+
+        >>> g = BellmanFord({'a': {'b': 1, 'c':5}, 'b': {'c': 2, 'a': 10}, 'c': {'a': 14, 'd': -3}, 'e': {'a': 100}})
+        >>> dist, prev, neg_edge = g.spfa_shortest_paths('a', 0)
+        >>> [(v, dist[v]) for v in sorted(dist)]
+        [('a', 0.0), ('b', 1.0), ('c', 3.0), ('d', 0.0), ('e', inf)]
+        >>> neg_edge is None
+        True
+        >>> g.add_edge(('a', 'e', -200))
+        >>> g.spfa_shortest_paths('a', 0)[2]
+        ('e', 'a')
+
+        :param start_vertex: start of all paths
+        :param tolerance: only if a path is more than tolerance better will it be relaxed
+        :return: distance, predecessor, negative_cycle as for shortest_paths
+        """
+        start = self.vertex_id[start_vertex]
+        self.dist[:] = self.unreached
+        self.pred[:] = self.no_pred
+        self.dist[start] = 0.0
+
+        self.source = start
+        self.tolerance = tolerance
+        self.valid = True
+        self.clear_queue()
+        self.queue.append(start)
+        self.in_queue[start] = True
+        return self.by_name(self.dist, self.pred, self.drain(start, tolerance))
+
+    def drain(self, start, tolerance):
+        """
+        Helper function to run the spfa kernel on our state, dropping the state if it found a negative cycle.
+
+        :param start: index of the start vertex
+        :param tolerance: only if a path is more than tolerance better will it be relaxed
+        :return: None if no negative cycle, otherwise an edge (u, v) of vertex indices whose
+            predecessor chain runs into one such cycle
+        """
+        neg_cycle = spfa(self.out, self.v_idx, self.w, start, tolerance, self.dist, self.pred,
+                         self.queue, self.in_queue)
+        if neg_cycle is not None:
+            self.valid = False
+            self.clear_queue()
+        return neg_cycle
+
+    def clear_queue(self):
+        """
+        Helper function to empty the queue of vertices waiting to be re-relaxed
+        """
+        for u in self.queue:
+            self.in_queue[u] = False
+        self.queue.clear()
+
+    def by_name(self, dist, pred, neg_cycle):
+        """
+        Helper function to hand index based results back to the client keyed by vertex name. The
+        distance and predecessor mappings are views over our own lists, valid until the graph changes.
+
+        :param: dist: list of distances indexed by vertex index
+        :param: pred: list of predecessor indices, -1 when there's none
+        :param: neg_cycle: None, or an edge (u, v) of vertex indices
+        :return: distance, predecessor, negative_cycle keyed by vertex name
+        """
+        names = self.vertex_name
+        dist = VertexMap(dist, self)
+        pred = VertexMap(pred, self, translate=True)
+        if neg_cycle is not None:
+            neg_cycle = (names[neg_cycle[0]], names[neg_cycle[1]])
+        return dist, pred, neg_cycle
@@ -1,4 +1,7 @@
 from datetime import datetime, timedelta
+from functools import lru_cache
+from math import log
+from sys import intern
 import struct
 import ipaddress
 from array import array
@@ -26,6 +29,13 @@ Format of subscription request: 4-byte IPv4 in big-endian, followed by 2-byte po
 
 MAX_QUOTES_PER_MESSAGE = 50
 MICROS_PER_SECOND = 1_000_000
+QUOTE_LENGTH = 32
+EPOCH = datetime(1970, 1, 1)
+
+#Big-endian timestamp, the 6 bytes of the currency pair, raw price bytes, then the 10 reserved bytes.
+#The price is little-endian so it's unpacked on its own by PRICE_FORMAT.
+QUOTE_FORMAT = struct.Struct('>Q6s8s10x')
+PRICE_FORMAT = struct.Struct('<d')
 
 def deserialized_price(x: bytes) -> float:
     """
@@ -71,43 +81,64 @@ def deserialize_utcdatetime(stamp: bytes) -> datetime:
 
     return timeStamp
 
+@lru_cache(maxsize=1024)
+def currency_pair(raw: bytes) -> tuple:
+    """
+    Decode the currency pair of a quote. Cached on the raw bytes, since a provider only quotes a
+    handful of markets.
+    The codes are interned so every quote for a currency shares one string, making graph lookups identity checks
+
+    :param raw: 6 bytes of the two ASCII currency codes
+    :return: the pair of currency codes
+    """
+    return intern(raw[:3].decode('ascii')), intern(raw[3:].decode('ascii'))
+
+@lru_cache(maxsize=4096)
+def price_and_weight(raw: bytes) -> tuple:
+    """
+    Decode the raw price bytes of a quote along with its graph weight. Cached on the raw bytes,
+    since a market often repeats the same price from one message to the next.
+
+    :param raw: 8 bytes of the price in IEEE 754 binary64 little-endian format
+    :return: the price and -log(price)
+    """
+    [price] = PRICE_FORMAT.unpack(raw)
+    return price, -log(price)
+
 def unmarshal_message(msg: bytes) -> list:
     """
     Unmarshal a byte stream from Forex Provider with quotes
-    >Each record is 32 bytes
+    >Each record is 32 bytes, parsed in one pass by QUOTE_FORMAT
+
+    >>> from fxp_bytes import marshal_message
+    >>> b = marshal_message([{'timestamp': datetime(2006,1,2), 'cross': 'GBP/USD', 'price': 1.22041},
+    ...                      {'timestamp': datetime(2006,1,1), 'cross': 'USD/JPY', 'price': 108.2755}])
+    >>> quotes = unmarshal_message(b + b[:20])  # a trailing partial record is ignored
+    >>> len(quotes)
+    2
+    >>> q = quotes[0]
+    >>> q['timestamp'], q['cross1'], q['cross2'], q['price']
+    (1136160000000000, 'GBP', 'USD', 1.22041)
+    >>> q['neg_log'] == -log(1.22041)
+    True
+    >>> quotes[1]['cross1'] is q['cross2']  # currency codes are interned
+    True
 
     :param msg: byte stream of list of quotes
-    :return the list of quotes as a list of dictionaries
+    :return the list of quotes as a list of dictionaries, with 'timestamp' kept as integer microseconds since
+        the epoch, each also carrying the graph weight 'neg_log' = -log(price) so it's only computed once per quote
     """
-    QUOTE_LENGTH = 32
-    endcoding = 'utf-8'
-    timestamp = 8
-    currency1 = timestamp + 3
-    currency2 = currency1 + 3
-    price = currency2 + 8
-    
-    #Reads the message for every 32 bytes
-    quotes = (int) (len(msg) / QUOTE_LENGTH)
-
+    #Reads the message for every 32 bytes, ignoring a trailing partial record
+    whole = len(msg) - len(msg) % QUOTE_LENGTH
     toReturn = []
-    start = startQ = 0
-    stopQ = 33
-    
-    for quote in range(0, quotes):
+
+    for stamp, pair, raw_price in QUOTE_FORMAT.iter_unpack(memoryview(msg)[:whole]):
         q = {}
-        data = msg[startQ:stopQ]
-
-        q['timestamp'] = deserialize_utcdatetime(data[start:start+timestamp])
-        
-        q['cross1']  = str(data[start+timestamp:start+currency1], endcoding)
-        q['cross2']  = str(data[start+currency1:start+currency2], endcoding)
-        
-        q['price'] = deserialized_price(data[start+currency2:start+price])
+        q['timestamp'] = stamp
+        q['cross1'], q['cross2'] = currency_pair(pair)
+        q['price'], q['neg_log'] = price_and_weight(raw_price)
         toReturn.append(q)
 
-        startQ += 32
-        stopQ += 32
-
     return toReturn
 
 def subscribe(sock, host_addr: tuple, server_addr: tuple):
@@ -1,9 +1,13 @@
 import socket
-from fxp_bytes_subscriber import unmarshal_message, subscribe
+from fxp_bytes_subscriber import unmarshal_message, subscribe, EPOCH, MICROS_PER_SECOND
 from bellman_ford import BellmanFord
-from math import log
-from datetime import datetime
+from datetime import timedelta
 import selectors
+import heapq
+from time import time_ns, monotonic_ns
+import logging
+import signal
+import os
 import sys
 
 """
@@ -33,12 +37,18 @@ negative cycles, just need to report whichever was discovered first.
     > Can also shutdown if not receive any published message for > 1 minute.
 """
 
+logger = logging.getLogger(__name__)
+
 class Lab3:
 
     SUB_EXPIRATION =  10 * 60    #10 minutes
     VALID_DURATION = 1.5    #1.5 seconds
-    SELECTOR_CHECK = 0.3
+    VALID_MICROS = int(VALID_DURATION * MICROS_PER_SECOND)
+    NANOS_PER_SECOND = 1_000_000_000
+    NANOS_PER_MICRO = 1000
     BUF_SZ = 4096
+    RECV_BATCH = 16     #most datagrams read per wake-up
+    RCVBUF_SZ = 8 << 20     #8MB kernel receive buffer, so bursts of quotes aren't dropped
     TOLERENCE = 1e-12
 
     def __init__(self, prov) -> None:
@@ -49,12 +59,12 @@ class Lab3:
         """
         self.provider_address = prov
         self.marketLibrary = {}
+        self.expire_heap = []   #(monotonic expiry ns, quote timestamp, market), the soonest to expire on top
 
         self.selector = selectors.DefaultSelector()
         self.listener, self.listener_address = self.start_a_server()
 
         self.foundArbitrage = False
-        self.foundLoop = False
 
     def start_a_server(self):
         """Function to start a generic server
@@ -62,6 +72,10 @@ class Lab3:
         :return: a tuple of the socket that's the server, and the socket's name"""
         node_address = ('localhost', 0)
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF_SZ)
+        #Lets more subscriber processes share the port later on (not available on every platform)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.bind(node_address)
         sock.setblocking(False)
         return (sock, sock.getsockname())
@@ -74,45 +88,100 @@ class Lab3:
 
         #Registering the socket without a callback for this socket
         self.selector.register(self.listener, selectors.EVENT_READ, data=None)
+        self.watch_signals()
 
         sent = subscribe(self.listener, self.listener_address, self.provider_address)
-        timer = self.stamp()
+        timer = monotonic_ns()
 
         try:
-            while True:
-                events = self.selector.select(self.SELECTOR_CHECK)
+            running = True
+            while running:
+                #Sleep until data arrives or the next quote/subscription deadline, whichever comes first
+                events = self.selector.select(self.next_timeout(timer))
                 for key, mask in events:
+                    #A signal arrived, stop once this round of events is handled
+                    if key.data == 'shutdown':
+                        running = False
+
                     #When a peer sent me a message
-                    if mask & selectors.EVENT_READ:
+                    elif mask & selectors.EVENT_READ:
                         self.receive_msg(key.fileobj)
                 
-                self.check_timeouts(timer)
+                if running:
+                    self.check_timeouts(timer)
         except KeyboardInterrupt as e:
-            print('\nShutting down....')
+            pass
+        finally:
+            self.close()
+
+        logger.info('\nShutting down....')
+
+    def watch_signals(self):
+        """
+        Function to have signals wake the selector: the signal number is written to a pipe that's
+        registered with the selector, so SIGTERM ends the loop like Ctrl-C does instead of killing us
+        """
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        signal.set_wakeup_fd(self.wakeup_w)
+
+        #Python only writes to the wakeup pipe for signals it handles, the pipe does the rest
+        signal.signal(signal.SIGTERM, lambda signum, frame: None)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, data='shutdown')
+
+    def close(self):
+        """
+        Function to release the selector, the listening socket and the signal pipe on shutdown
+        """
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.selector.close()
+        self.listener.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
 
 
     def receive_msg(self,sock):
         """
-        Function to receive a message. Each successfully received message will cause a check for arbitrage.
+        Function to receive messages. Every datagram already waiting on the socket (up to RECV_BATCH)
+        is read on this wake-up, then they're all checked for arbitrage together.
 
         :param: sock: the socket from which to receive message
         """
-        try:
-            data = sock.recv(self.BUF_SZ)
-            #print(msg)
-        except Exception as err:
-            print('Failure accepting data from peer: {}'.format(err))
-        else:
-            self.checkArbitrage(data)
+        batch = []
+        while len(batch) < self.RECV_BATCH:
+            try:
+                batch.append(sock.recv(self.BUF_SZ))
+            except BlockingIOError:
+                break   #socket drained
+            except Exception as err:
+                logger.error('Failure accepting data from peer: %s', err)
+                break
+
+        if batch:
+            self.checkArbitrage(*batch)
+
+    def next_timeout(self, timer):
+        """
+        Function to work out how long the selector can wait before a timeout check is due
+
+        :param: timer: the monotonic time in ns for when subscription started
+        :return: seconds until the soonest quote expiry or the subscription expiry
+        """
+        deadline = timer + self.SUB_EXPIRATION * self.NANOS_PER_SECOND
+        if self.expire_heap:
+            deadline = min(deadline, self.expire_heap[0][0])
+        return max(0, deadline - monotonic_ns()) / self.NANOS_PER_SECOND
 
     def check_timeouts(self, timer):
         """
         Function to check on timeouts
 
-        :param: timer: the time stamp for when subscription started
+        :param: timer: the monotonic time in ns for when subscription started
         """
         if self.is_expired(timer, self.SUB_EXPIRATION):
-            print('Subscription expired. Shutting down...')
+            logger.info('Subscription expired. Shutting down...')
             exit(1)
 
         self.checkExpiredQuotes()
@@ -120,34 +189,59 @@ class Lab3:
 
     def checkExpiredQuotes(self):
         """
-        Function to remove expired quotes from our library and our graph
-
-        :param: g: the graph containing the edges
+        Function to remove expired quotes from our library and our graph. Only the markets at the top of
+        the expiry heap are looked at; entries left behind by a newer quote for the same market are skipped.
         """
-        time = 0
-        removed = []
-        for market in self.marketLibrary:
-            #Remove quote when expired
-            if self.is_expired(self.marketLibrary[market][time], self.VALID_DURATION):
-                print('removing stale quote for ({}, {})'.format(market[0], market[1]))
-                self.g.remove_edge(market[0], market[1])
-                self.g.remove_edge(market[1], market[0])
-                removed.append(market)
+        TIME_KEY = 0
+        now = monotonic_ns()
+        while self.expire_heap and self.expire_heap[0][0] <= now:
+            expire_at, stamp, market = heapq.heappop(self.expire_heap)
+
+            #Market already gone, or its quote was superseded since this entry was pushed
+            if market not in self.marketLibrary or self.marketLibrary[market][TIME_KEY] != stamp:
+                continue
 
-        for item in removed:
-            del self.marketLibrary[item]
+            logger.debug('removing stale quote for (%s, %s)', market[0], market[1])
+            self.g.remove_edge(market[0], market[1])
+            self.g.remove_edge(market[1], market[0])
+            del self.marketLibrary[market]
 
 
-    def checkArbitrage(self, data:dict):
+    def checkArbitrage(self, *messages):
         """
-        Function to process the quotes and check for arbitrage opportunities
+        Function to process the quotes and check for arbitrage opportunities. All quotes of the messages
+        go into the market library first, then each updated market is written to the graph once and
+        Bellman-Ford runs once on the result.
 
-        :param: g: the graph used to track arbitrage
-        :param: data: message received from provider
+        :param: messages: one or more messages received from provider
         """
         #Unload the messages
-        quotes = unmarshal_message(data)
+        updated = {}
+        for data in messages:
+            self.apply_quotes(unmarshal_message(data), updated)
+        self.update_graph(updated)
+
+        #No arbitrage is possible until there's at least a triangle of trades in and out of USD
+        if self.g.edge_count() < 3 or not self.g.on_cycle_possible('USD'):
+            return
+
+        #None of the new quotes made a path any shorter, so they can't have opened up an arbitrage
+        if self.g.is_settled('USD', self.TOLERENCE):
+            return
+
+        dist, pred, neg_cycle = self.g.incremental_paths('USD', self.TOLERENCE)
+        if neg_cycle:
+            #Only need to report the first found negative cycle
+            self.print_path(self.get_path(pred, neg_cycle))
+
+    def apply_quotes(self, quotes, updated):
+        """
+        Function to update the market library with the quotes of a message
 
+        :param: quotes: the unmarshalled quotes
+        :param: updated: dict collecting the markets whose quote changed, for update_graph, ordered by
+            their latest accepted quote
+        """
         for quote in quotes:
             self.prt_quote(quote)
 
@@ -156,105 +250,89 @@ class Lab3:
 
             #only accept in order messages
             if not self.is_in_order(quote): 
-                print('\nIgnoring out-of-order message')
+                logger.debug('\nIgnoring out-of-order message')
                 continue
 
-            #Otherwise, store it in our Bellman algorithm
-            edge = (quote['cross1'], quote['cross2'], -1 * log(quote['price']))
-            recipEdge = (quote['cross2'], quote['cross1'], log(quote['price']))
-            self.g.add_edge(edge)
-            self.g.add_edge(recipEdge)
+            #(a, b) and (b, a) write the same pair of edges, move the market to the end so the latest quote wins
+            market = (quote['cross1'], quote['cross2'])
+            updated.pop(market, None)
+            updated[market] = True
 
-            for v in self.g.vertices:
-                dist, pred, neg_cycle = self.g.shortest_paths('USD', self.TOLERENCE)
-                if neg_cycle:
-                    #print('arbitrage', neg_cycle, pred, dist)
-                    self.print_path(self.get_path(pred, neg_cycle))
+    def update_graph(self, markets):
+        """
+        Function to store the latest quote of each market in our Bellman algorithm, once per market
+        however many quotes it got in the batch
 
-                    if self.foundLoop:
-                        print('Path found has a infinite loop')
-                        print('\n\nEdges: ', self.g.edges, '\nDist: ', dist, 'Pred: ', pred)
-                        self.foundLoop = False
-                        #exit(1)
-                    #Only need to report the first found negative cycle
-                    break   
+        :param: markets: the markets to update, in the order their latest quote was accepted
+        """
+        WEIGHT_KEY = 2
+        for market in markets:
+            weight = self.marketLibrary[market][WEIGHT_KEY]
+            self.g.add_edge((market[0], market[1], weight))
+            self.g.add_edge((market[1], market[0], -weight))
 
-    def get_path(self, pred, cycle):
+    @staticmethod
+    def get_path(pred, cycle):
         """
-        Entry point for getting a path, this then calls the recursive version to get the path
+        Static function to get the trading path of an arbitrage by walking back the predecessors from the
+        edge where the negative cycle was noticed. If the predecessors loop back on themselves before
+        reaching the start vertex, only that loop is returned, since it is the actual arbitrage.
+
+        >>> Lab3.get_path({'USD': None, 'EUR': 'USD', 'GBP': 'EUR'}, ('GBP', 'USD'))
+        ['USD', 'EUR', 'GBP', 'USD']
+        >>> pred = {'USD': None, 'CAD': 'EUR', 'EUR': 'GBP', 'GBP': 'CHF', 'CHF': 'EUR'}
+        >>> Lab3.get_path(pred, ('CAD', 'USD'))  # CAD leads into the EUR loop, which doesn't pass through USD
+        ['EUR', 'CHF', 'GBP', 'EUR']
 
         :param: pred: the predecessors dictionary
         :param: cycle: the last edge seen in the cycle, used to trace back
-        :return: the path extracted from the predecessor list
+        :return: the path extracted from the predecessor list, in trading order
         """
-
+        path = [cycle[1]]
+        seen = set()
         vertex = cycle[0]
-        path = list()
-        self.get_path_recur(pred, vertex, path)
-        path.append(cycle[1])
+        while vertex is not None and vertex not in seen:
+            seen.add(vertex)
+            path.append(vertex)
+            vertex = pred[vertex]
 
-        #print(path)
+        #Predecessors looped back to vertex, rotate the path so it starts and ends there
+        if vertex is not None:
+            path = path[path.index(vertex, 1):] + [vertex]
 
+        path.reverse()
         return path
 
-    def get_path_recur(self, pred, vertex, path, counter = 0):
-        """
-        Helper function to recursively look for the predecessor of a vertice in the shortest path
-
-        :param: pred: the predecessor dictionary
-        :param: vertex: the vertex whose parent we need
-        :param: path: a memory to conveniently store the parents in order
-        """
-        if counter == 10:
-            print('Infinite loop.')
-            self.foundLoop = True
-
-            return
-
-        #base condition
-        if pred[vertex] is None:
-            path.append(vertex)
-            return
-        
-        self.get_path_recur(pred, pred[vertex], path, counter + 1)
-        path.append(vertex)
-
     def print_path(self, path):
         """
         Function to help print out the arbitrage and take care removing the edges
 
         :param: path: the list containing the path that lead to an arbitrage
         """
-        if self.foundLoop: return
-
         PRICE = 1
         units = 100
         start = path[len(path) - 1]
 
         i = 0
-        print('ARBITRAGE:\n\tstart with {} {}' .format(start, units))
+        logger.info('ARBITRAGE:\n\tstart with %s %s', start, units)
         while(i < len(path)- 1):
-            try:
-                market = (path[i], path[i+1])
+            sell, buy = path[i], path[i+1]
+            market = (sell, buy)
+            if market in self.marketLibrary:
                 rate = self.marketLibrary[market][PRICE]
-                units = units * rate
-                print('\n\texchange {} for {} at {} -----> {} {}'.format(market[0], market[1], rate, market[1], units))
-                
-                self.g.remove_edge(market[0], market[1])
-                self.g.remove_edge(market[1], market[0])
-                del self.marketLibrary[market]
 
             #case when the direction is backwards
-            except KeyError as e:
-                market = (path[i+1], path[i])
+            else:
+                market = (buy, sell)
                 rate = 1 / self.marketLibrary[market][PRICE]
-                units = units * rate
-                print('\n\texchange {} for {} at {} -----> {} {}'.format(market[1], market[0], rate, market[0], units))
 
-                self.g.remove_edge(market[1], market[0])
-                self.g.remove_edge(market[0], market[1])
-                del self.marketLibrary[market]
-            
+            units = units * rate
+            logger.info('\n\texchange %s for %s at %s -----> %s %s', sell, buy, rate, buy, units)
+
+            self.g.remove_edge(market[0], market[1])
+            self.g.remove_edge(market[1], market[0])
+            del self.marketLibrary[market]
+
             i+=1
 
 
@@ -270,7 +348,7 @@ class Lab3:
 
         #start tracking if not in library already
         if key not in self.marketLibrary:
-            self.marketLibrary[key] = [time, price]
+            self.marketLibrary[key] = [time, price, quote['neg_log']]
         
     def is_in_order(self, quote):
         """
@@ -280,6 +358,7 @@ class Lab3:
         """
         TIME_KEY = 0
         PRICE_KEY = 1
+        WEIGHT_KEY = 2
         key = (quote['cross1'], quote['cross2'])
         time = quote['timestamp']
         price = quote['price']
@@ -291,49 +370,54 @@ class Lab3:
         #otherwise update
         self.marketLibrary[key][TIME_KEY] = time
         self.marketLibrary[key][PRICE_KEY] = price
-        #Update in the graph too
-        edge = (quote['cross1'], quote['cross2'], -1 * log(price))
-        recipEdge = (quote['cross2'], quote['cross1'], log(price))
-        self.g.add_edge(edge)
-        self.g.add_edge(recipEdge)
+        self.marketLibrary[key][WEIGHT_KEY] = quote['neg_log']
+        #The quote's own timestamp is wall-clock, turn its expiry into a deadline on the monotonic clock
+        expire_at = monotonic_ns() + (time + self.VALID_MICROS - self.stamp()) * self.NANOS_PER_MICRO
+        heapq.heappush(self.expire_heap, (expire_at, time, key))
         return True
 
     def is_expired(self, stamp, threshold, utc=False):
         """Helper function to check if the time has passed the threshold
         
-        :param: peer: the peer to get time checked
-        :param: threshold: the threshold to check against
+        :param: stamp: the time to check, from time.monotonic_ns()
+        :param: threshold: the threshold to check against, in seconds
         :return: True if timepassed is greater than threshold. False otherwise"""
 
 
-        timepassed = (datetime.utcnow() - stamp).total_seconds()    #get the time delta in seconds
-        return threshold < timepassed
+        timepassed = monotonic_ns() - stamp    #get the time delta in ns
+        return threshold * self.NANOS_PER_SECOND < timepassed
 
     @staticmethod
     def stamp():
         """Static helper function to give the current time
         
-        :return: current time as a Datetime object"""
-        return datetime.utcnow() 
+        :return: current time in microseconds since the epoch"""
+        return time_ns() // 1000
             
 
     def prt_quote(self, quote):
         """
-        Helper function to print the quote in format
+        Helper function to log the quote in format, at DEBUG level. Nothing is formatted unless DEBUG
+        is enabled, since this runs for every quote.
 
         :param: quote: the quote to be printed
         """
-        time = quote['timestamp'].strftime('%Y/%m/%d %H:%M:%S.%f')
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+
+        stamp = (EPOCH + timedelta(microseconds=quote['timestamp'])).isoformat(sep=' ', timespec='microseconds')
         curr = quote['cross1']
         curr += ' ' + quote['cross2']
         price = quote['price']
 
-        print('{} {} {}'.format(time, curr, price))
+        logger.debug('%s %s %s', stamp, curr, price)
 
 if __name__ == '__main__':
     """     
     Entry point for program
     """
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
     if len(sys.argv) != 3:
         print('USAGE: python lab3.py PROVIDER_IP PROVIDER_PORT')
         exit(1)